@@ -1,9 +1,11 @@
 # app.py — Render Web Service (Python + FastAPI + Postgres via psycopg3)
-import os, httpx, math
+import os, re, httpx, math, asyncio, logging, orjson
+from contextlib import asynccontextmanager, nullcontext
+from cachetools import TTLCache
 from fastapi import FastAPI, Request, Header
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import Response, PlainTextResponse, ORJSONResponse
 
-from psycopg_pool import AsyncConnectionPool
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
 from psycopg.rows import dict_row
 
 BOT_TOKEN = os.environ["BOT_TOKEN"]
@@ -11,16 +13,63 @@ WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
 DATABASE_URL = os.environ["DATABASE_URL"]
 API = f"https://api.telegram.org/bot{BOT_TOKEN}"
 
-app = FastAPI()
+log = logging.getLogger("aceminibot")
 
-# small async pool
+# one keep-alive client for all Telegram calls (created on startup)
+http_client: httpx.AsyncClient | None = None
+# our @username from getMe; group commands addressed to other bots are ignored
+bot_username: str | None = None
+
+async def fetch_bot_username():
+    global bot_username
+    try:
+        resp = await http_client.get("/getMe")
+        resp.raise_for_status()  # e.g. 401 on a bad BOT_TOKEN
+        bot_username = resp.json()["result"]["username"].lower()
+        log.debug("telegram api reachable over %s", resp.http_version)
+    except (httpx.HTTPError, KeyError, ValueError):
+        log.warning("getMe failed; bot username still unknown", exc_info=True)
+
+@asynccontextmanager
+async def lifespan(app):
+    global http_client
+    http_client = httpx.AsyncClient(
+        base_url=API, http2=True,  # parallel sends multiplex over one TLS connection
+        timeout=httpx.Timeout(10.0, connect=3.0),
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+    )
+    await fetch_bot_username()  # retried lazily on /cmd@Name if this fails
+    try:
+        yield
+    finally:
+        # updates already acked to Telegram: give them a bounded chance to finish,
+        # then cancel stragglers so none is left using the client after aclose()
+        if _tasks:
+            _, pending = await asyncio.wait(_tasks, timeout=20)
+            for t in pending:
+                t.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        await http_client.aclose()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# async pool: keep a couple of warm connections, room for bursts
 pool = AsyncConnectionPool(
     DATABASE_URL,
-    min_size=1, max_size=3,
-    kwargs={"autocommit": True}  # we use simple statements; autocommit is fine here
+    min_size=2, max_size=10, max_idle=300,
+    timeout=2.0,  # fail fast with PoolTimeout rather than queue behind slow queries
+    kwargs={"autocommit": True,   # we use simple statements; autocommit is fine here
+            "prepare_threshold": 0}  # prepare server-side on first use (psycopg: 0 = first, 1 = second)
 )
 
+# per-process profile cache (single Render instance); dropped on every write
+profile_cache = TTLCache(maxsize=10000, ttl=300)
+# bumped after every write; a read only fills the cache if no write landed
+# while its SELECT was in flight (otherwise it may hold the pre-write row)
+profile_writes = 0
+
 ACT_MAP = {1:1.2, 2:1.375, 3:1.55, 4:1.725, 5:1.9}
+SEX_OFFSET = {'M': 5, 'F': -161}  # Mifflin-St Jeor sex constant
 
 HELP = (
 "Hi! I can store your fitness profile and do quick checks.\n\n"
@@ -33,6 +82,15 @@ HELP = (
 "/edit field value  → update one item (fields: name, sex, age, height, weight, activity)\n"
 "  e.g.  /edit weight 74.5\n"
 )
+# sendMessage body for HELP minus the chat_id; only the id is spliced in per call
+HELP_PAYLOAD_TAIL = orjson.dumps({"text": HELP})[1:]
+
+OK_BODY = b"ok"
+JSON_HEADERS = {"content-type": "application/json"}
+
+def ok():
+    # Responses are single-use, but building one from a constant body is cheap
+    return Response(OK_BODY, media_type="text/plain")
 
 def clean_int(x): return int(str(x).strip())
 def clean_float(x): return float(str(x).strip())
@@ -48,161 +106,250 @@ def bmi_label(b):
     return "Obese"
 
 def mifflin_bmr(sex, age, height_cm, weight_kg):
-    if sex == 'M':
-        return 10*weight_kg + 6.25*height_cm - 5*age + 5
-    else:
-        return 10*weight_kg + 6.25*height_cm - 5*age - 161
+    return 10*weight_kg + 6.25*height_cm - 5*age + SEX_OFFSET[sex]
 
 def tdee(sex, age, height_cm, weight_kg, activity):
     return mifflin_bmr(sex, age, height_cm, weight_kg) * ACT_MAP.get(activity, 1.2)
 
 async def send(chat_id, text):
-    async with httpx.AsyncClient(timeout=15) as client:
-        await client.post(f"{API}/sendMessage", json={"chat_id": chat_id, "text": text})
+    await send_raw(orjson.dumps({"chat_id": chat_id, "text": text}))
 
-async def upsert_profile(user_id, chat_id, name=None, sex=None, age=None, height_cm=None, weight_kg=None, activity=None):
-    async with pool.connection() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute("SELECT 1 FROM user_profile WHERE user_id=%s", (user_id,))
-            exists = await cur.fetchone()
-        async with conn.cursor() as cur:
-            if exists:
-                await cur.execute("""
-                  UPDATE user_profile
-                  SET name=COALESCE(%s,name),
-                      sex=COALESCE(%s,sex),
-                      age=COALESCE(%s,age),
-                      height_cm=COALESCE(%s,height_cm),
-                      weight_kg=COALESCE(%s,weight_kg),
-                      activity=COALESCE(%s,activity),
-                      updated_at=now()
-                  WHERE user_id=%s
-                """, (name, sex, age, height_cm, weight_kg, activity, user_id))
-            else:
-                await cur.execute("""
-                  INSERT INTO user_profile (user_id, chat_id, name, sex, age, height_cm, weight_kg, activity)
-                  VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
-                """, (user_id, chat_id, name, sex, age, height_cm, weight_kg, activity))
+async def send_raw(payload):
+    await http_client.post("/sendMessage", content=payload, headers=JSON_HEADERS)
+
+async def upsert_profile(user_id, chat_id, name=None, sex=None, age=None, height_cm=None, weight_kg=None, activity=None, conn=None):
+    # single round-trip; needs a unique key on user_profile.user_id
+    async with (nullcontext(conn) if conn else pool.connection()) as conn:
+        await conn.execute("""
+          INSERT INTO user_profile (user_id, chat_id, name, sex, age, height_cm, weight_kg, activity)
+          VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
+          ON CONFLICT (user_id) DO UPDATE SET
+            name=COALESCE(EXCLUDED.name, user_profile.name),
+            sex=COALESCE(EXCLUDED.sex, user_profile.sex),
+            age=COALESCE(EXCLUDED.age, user_profile.age),
+            height_cm=COALESCE(EXCLUDED.height_cm, user_profile.height_cm),
+            weight_kg=COALESCE(EXCLUDED.weight_kg, user_profile.weight_kg),
+            activity=COALESCE(EXCLUDED.activity, user_profile.activity),
+            updated_at=now()
+        """, (user_id, chat_id, name, sex, age, height_cm, weight_kg, activity))
+    global profile_writes
+    profile_writes += 1
+    profile_cache.pop(user_id, None)
 
 async def get_profile(user_id):
+    row = profile_cache.get(user_id)
+    if row is not None:
+        return row
+    writes = profile_writes
     async with pool.connection() as conn:
         async with conn.cursor(row_factory=dict_row) as cur:
-            await cur.execute("SELECT * FROM user_profile WHERE user_id=%s", (user_id,))
-            return await cur.fetchone()
+            await cur.execute("""
+              SELECT name, sex, age, height_cm, weight_kg, activity
+              FROM user_profile WHERE user_id=%s
+            """, (user_id,))
+            row = await cur.fetchone()
+    if row is not None and writes == profile_writes:
+        profile_cache[user_id] = row
+    return row
 
 @app.get("/healthz")
 async def healthz():
-    return PlainTextResponse("ok")
+    return ok()
+
+# strong refs so pending handler tasks aren't garbage-collected mid-flight
+_tasks = set()
+# user_id -> [lock, number of updates holding or waiting on it]
+_user_locks = {}
 
 @app.post("/telegram")
 async def telegram(req: Request, x_telegram_bot_api_secret_token: str | None = Header(None)):
     if WEBHOOK_SECRET and (x_telegram_bot_api_secret_token != WEBHOOK_SECRET):
         return PlainTextResponse("unauthorized", status_code=401)
 
-    data = await req.json()
+    try:
+        data = orjson.loads(await req.body())
+    except orjson.JSONDecodeError:
+        return ok()  # malformed body: ack so Telegram doesn't keep retrying it
+    # ack Telegram right away; the command runs in the background
+    task = asyncio.create_task(_handle(data))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return ok()
+
+async def _handle(data):
+    # one update per user at a time, in arrival order (asyncio.Lock is FIFO),
+    # as Telegram would deliver them if we awaited the handler before acking
+    try:
+        msg = data.get("message") or data.get("edited_message") or {}
+        key = (msg.get("from") or {}).get("id")
+        if key is None:
+            # callback_query, channel_post, ...: no user to order by
+            return await _dispatch(data)
+        entry = _user_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await _dispatch(data)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del _user_locks[key]
+    except Exception:
+        log.exception("update handling failed")
+
+# write + confirmation in parallel; the reply doesn't depend on the write,
+# so follow up with an error if the write fails. The connection is taken
+# before acking, so a PoolTimeout reaches _dispatch ("Busy") with no ack sent,
+# and it is returned as soon as the write is done, not held for the ack.
+async def save_and_ack(user_id, chat_id, ack, **fields):
+    saved = None
+    async with pool.connection() as conn:
+        acked = asyncio.create_task(send(chat_id, ack))
+        try:
+            await upsert_profile(user_id, chat_id, conn=conn, **fields)
+        except Exception as e:
+            saved = e
+    (sent,) = await asyncio.gather(acked, return_exceptions=True)
+    if isinstance(saved, Exception):
+        log.error("profile write failed", exc_info=saved)
+        await send(chat_id, "Sorry, that didn't save. Please try again.")
+    if isinstance(sent, Exception):
+        raise sent
+
+async def h_help(chat_id, user_id, rest):
+    await send_raw(b'{"chat_id":%d,' % chat_id + HELP_PAYLOAD_TAIL)
+
+async def h_profile(chat_id, user_id, rest):
+    row = await get_profile(user_id)
+    if not row:
+        await send(chat_id, "No profile yet. Set it with:\n/setprofile Name, Sex(M/F), Age, Height_cm, Weight_kg, Activity(1-5)")
+    else:
+        msgp = (f"Your profile:\n"
+                f"Name: {row.get('name')}\nSex: {row.get('sex')}\nAge: {row.get('age')}\n"
+                f"Height: {row.get('height_cm')} cm\nWeight: {row.get('weight_kg')} kg\n"
+                f"Activity (1-5): {row.get('activity')}")
+        await send(chat_id, msgp)
+
+async def h_setprofile(chat_id, user_id, rest):
+    if not rest:
+        await send(chat_id, "Format:\n/setprofile Name, Sex(M/F), Age, Height_cm, Weight_kg, Activity(1-5)")
+        return
+    parts = [p.strip() for p in rest.split(",")]
+    if len(parts) != 6:
+        await send(chat_id, "Please send exactly 6 items, e.g.\n/setprofile Ace, M, 22, 175, 76, 3")
+        return
+    try:
+        name = parts[0]
+        sex = parts[1].upper()
+        age = clean_int(parts[2])
+        height_cm = clean_int(parts[3])
+        weight_kg = clean_float(parts[4])
+        activity = clean_int(parts[5])
+        if sex not in ("M","F") or activity not in (1,2,3,4,5):
+            raise ValueError("bad sex/activity")
+    except Exception:
+        await send(chat_id, "Could not read that. Example:\n/setprofile Ace, M, 22, 175, 76, 3")
+        return
+    await save_and_ack(user_id, chat_id, "Saved ✅  (Use /profile to check)",
+                       name=name, sex=sex, age=age, height_cm=height_cm,
+                       weight_kg=weight_kg, activity=activity)
+
+async def h_edit(chat_id, user_id, rest):
+    if not rest:
+        await send(chat_id, "Format:\n/edit field value\nFields: name, sex(M/F), age, height, weight, activity(1-5)")
+        return
+    try:
+        field, value = rest.split(" ", 1)
+        field = field.lower().strip()
+        value = value.strip()
+        updates = {}
+        if field == "name":
+            updates["name"] = value
+        elif field == "sex":
+            if value.upper() not in ("M","F"): raise ValueError
+            updates["sex"] = value.upper()
+        elif field == "age":
+            updates["age"] = clean_int(value)
+        elif field == "height":
+            updates["height_cm"] = clean_int(value)
+        elif field == "weight":
+            updates["weight_kg"] = clean_float(value)
+        elif field == "activity":
+            v = clean_int(value)
+            if v not in (1,2,3,4,5): raise ValueError
+            updates["activity"] = v
+        else:
+            await send(chat_id, "Unknown field.")
+            return
+    except Exception:
+        await send(chat_id, "Could not update. Example:\n/edit weight 74.5")
+        return
+    await save_and_ack(user_id, chat_id, "Updated ✅", **updates)
+
+async def h_bmi(chat_id, user_id, rest):
+    row = await get_profile(user_id)
+    if not row or not row.get("height_cm") or not row.get("weight_kg"):
+        await send(chat_id, "Please set height & weight first:\n/setprofile Name, Sex(M/F), Age, Height_cm, Weight_kg, Activity(1-5)")
+    else:
+        b = bmi_value(row["height_cm"], float(row["weight_kg"]))
+        await send(chat_id, f"BMI: {b:.1f} ({bmi_label(b)})")
+
+async def h_cutcal(chat_id, user_id, rest):
+    row = await get_profile(user_id)
+    need = ["sex","age","height_cm","weight_kg","activity"]
+    if not row or not all(row.get(k) for k in need):
+        await send(chat_id, "Please complete your profile first with /setprofile.")
+    else:
+        t = tdee(row["sex"], row["age"], row["height_cm"], float(row["weight_kg"]), row["activity"])
+        cut = max(t - 500, t - 300)
+        msgc = (f"Estimated maintenance (TDEE): {t:.0f} kcal/day\n"
+                f"Suggested to lose weight: ~{cut:.0f} kcal/day (300–500 kcal deficit).")
+        await send(chat_id, msgc)
+
+async def h_unknown(chat_id, user_id, rest):
+    await send(chat_id, "Unknown command. Use /start for help.")
+
+# "/cmd", "/cmd args" or group-style "/cmd@BotName args"
+CMD_RE = re.compile(r"^/(\w+)(?:@(\w+))?(?:\s+(.*))?$", re.DOTALL)
+
+# command -> handler(chat_id, user_id, rest); built once at import
+HANDLERS = {
+    "/start": h_help,
+    "/help": h_help,
+    "/profile": h_profile,
+    "/setprofile": h_setprofile,
+    "/edit": h_edit,
+    "/bmi": h_bmi,
+    "/cutcal": h_cutcal,
+}
+
+async def _dispatch(data):
     msg = data.get("message") or data.get("edited_message")
     if not msg:
-        return PlainTextResponse("ok")
+        return
 
     chat_id = msg["chat"]["id"]
     user_id = msg["from"]["id"]
     text = (msg.get("text") or "").strip()
+    # in groups, stay quiet about chatter and commands that aren't ours
+    private = msg["chat"].get("type") == "private"
     if not text.startswith("/"):
-        await send(chat_id, "Use /start for help.")
-        return PlainTextResponse("ok")
-
-    cmd, *rest = text.split(" ", 1)
-    cmd = cmd.lower()
-
-    if cmd in ("/start", "/help"):
-        await send(chat_id, HELP)
-
-    elif cmd == "/profile":
-        row = await get_profile(user_id)
-        if not row:
-            await send(chat_id, "No profile yet. Set it with:\n/setprofile Name, Sex(M/F), Age, Height_cm, Weight_kg, Activity(1-5)")
-        else:
-            msgp = (f"Your profile:\n"
-                    f"Name: {row.get('name')}\nSex: {row.get('sex')}\nAge: {row.get('age')}\n"
-                    f"Height: {row.get('height_cm')} cm\nWeight: {row.get('weight_kg')} kg\n"
-                    f"Activity (1-5): {row.get('activity')}")
-            await send(chat_id, msgp)
-
-    elif cmd == "/setprofile":
-        if not rest:
-            await send(chat_id, "Format:\n/setprofile Name, Sex(M/F), Age, Height_cm, Weight_kg, Activity(1-5)")
-        else:
-            parts = [p.strip() for p in rest[0].split(",")]
-            if len(parts) != 6:
-                await send(chat_id, "Please send exactly 6 items, e.g.\n/setprofile Ace, M, 22, 175, 76, 3")
-            else:
-                try:
-                    name = parts[0]
-                    sex = parts[1].upper()
-                    age = clean_int(parts[2])
-                    height_cm = clean_int(parts[3])
-                    weight_kg = clean_float(parts[4])
-                    activity = clean_int(parts[5])
-                    if sex not in ("M","F") or activity not in (1,2,3,4,5):
-                        raise ValueError("bad sex/activity")
-                    await upsert_profile(user_id, chat_id, name, sex, age, height_cm, weight_kg, activity)
-                    await send(chat_id, "Saved ✅  (Use /profile to check)")
-                except Exception:
-                    await send(chat_id, "Could not read that. Example:\n/setprofile Ace, M, 22, 175, 76, 3")
-
-    elif cmd == "/edit":
-        if not rest:
-            await send(chat_id, "Format:\n/edit field value\nFields: name, sex(M/F), age, height, weight, activity(1-5)")
-        else:
-            try:
-                field, value = rest[0].split(" ", 1)
-                field = field.lower().strip()
-                value = value.strip()
-                updates = {}
-                if field == "name":
-                    updates["name"] = value
-                elif field == "sex":
-                    if value.upper() not in ("M","F"): raise ValueError
-                    updates["sex"] = value.upper()
-                elif field == "age":
-                    updates["age"] = clean_int(value)
-                elif field == "height":
-                    updates["height_cm"] = clean_int(value)
-                elif field == "weight":
-                    updates["weight_kg"] = clean_float(value)
-                elif field == "activity":
-                    v = clean_int(value)
-                    if v not in (1,2,3,4,5): raise ValueError
-                    updates["activity"] = v
-                else:
-                    await send(chat_id, "Unknown field.")
-                    return PlainTextResponse("ok")
-
-                await upsert_profile(user_id, chat_id, **updates)
-                await send(chat_id, "Updated ✅")
-            except Exception:
-                await send(chat_id, "Could not update. Example:\n/edit weight 74.5")
-
-    elif cmd == "/bmi":
-        row = await get_profile(user_id)
-        if not row or not row.get("height_cm") or not row.get("weight_kg"):
-            await send(chat_id, "Please set height & weight first:\n/setprofile Name, Sex(M/F), Age, Height_cm, Weight_kg, Activity(1-5)")
-        else:
-            b = bmi_value(row["height_cm"], float(row["weight_kg"]))
-            await send(chat_id, f"BMI: {b:.1f} ({bmi_label(b)})")
-
-    elif cmd == "/cutcal":
-        row = await get_profile(user_id)
-        need = ["sex","age","height_cm","weight_kg","activity"]
-        if not row or not all(row.get(k) for k in need):
-            await send(chat_id, "Please complete your profile first with /setprofile.")
-        else:
-            t = tdee(row["sex"], row["age"], row["height_cm"], float(row["weight_kg"]), row["activity"])
-            cut = max(t - 500, t - 300)
-            msgc = (f"Estimated maintenance (TDEE): {t:.0f} kcal/day\n"
-                    f"Suggested to lose weight: ~{cut:.0f} kcal/day (300–500 kcal deficit).")
-            await send(chat_id, msgc)
-    else:
-        await send(chat_id, "Unknown command. Use /start for help.")
+        if private:
+            await send(chat_id, "Use /start for help.")
+        return
 
-    return PlainTextResponse("ok")
+    m = CMD_RE.match(text)
+    if m and m.group(2):
+        if bot_username is None:
+            await fetch_bot_username()
+        # drop /cmd@OtherBot; while our name is unknown, answer rather than go silent
+        if bot_username is not None and m.group(2).lower() != bot_username:
+            return
+    handler = m and HANDLERS.get("/" + m.group(1).lower())
+    if handler:
+        try:
+            await handler(chat_id, user_id, m.group(3))
+        except PoolTimeout:
+            await send(chat_id, "Busy, please retry in a moment.")
+    elif private:
+        await h_unknown(chat_id, user_id, None)
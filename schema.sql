@@ -0,0 +1,42 @@
+-- schema.sql — run once against DATABASE_URL (psql "$DATABASE_URL" -f schema.sql)
+
+CREATE TABLE IF NOT EXISTS user_profile (
+    user_id    bigint PRIMARY KEY,   -- every lookup is WHERE user_id=...; also the ON CONFLICT target
+    chat_id    bigint NOT NULL,
+    name       text,
+    sex        text,
+    age        integer,
+    height_cm  integer,
+    weight_kg  numeric,
+    activity   integer,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+
+-- older tables were created without a key on user_id. Those were filled by a
+-- SELECT-then-INSERT upsert that could race, so keep only the newest row per
+-- user_id first (the unique index below fails if duplicates remain).
+DELETE FROM user_profile a
+USING user_profile b
+WHERE a.user_id = b.user_id
+  AND (COALESCE(a.updated_at, '-infinity'), a.ctid)
+    < (COALESCE(b.updated_at, '-infinity'), b.ctid);
+
+-- no-op when user_id is already the primary key (user_profile_pkey covers it)
+-- or a unique index on exactly (user_id) exists
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_index i
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attname = 'user_id'
+        WHERE i.indrelid = 'user_profile'::regclass
+          AND i.indisunique AND i.indpred IS NULL
+          AND i.indkey::int2[] = ARRAY[a.attnum]
+    ) THEN
+        CREATE UNIQUE INDEX user_profile_user_id_key ON user_profile (user_id);
+    END IF;
+END $$;
+
+-- check: should be an Index Scan on the user_id key, not a Seq Scan
+--   EXPLAIN (ANALYZE, BUFFERS) SELECT name FROM user_profile WHERE user_id = 1;
+-- and \d user_profile should list no other indexes (they only slow the upsert)